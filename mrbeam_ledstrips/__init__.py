@@ -1,8 +1,32 @@
-from __future__ import (print_function, absolute_import)
+# the server is not imported here as it pulls in the LED libraries, which the cli doesn't need.
+# Its entry point is mrbeam_ledstrips.server:server
 
+_version_string = None
+
+
+def get_version_string():
+	# the version can't change while we're running, so look it up only once
+	global _version_string
+	if _version_string is None:
+		_version_string = _get_version_string()
+	return _version_string
+
+
+def _get_version_string():
+	# pkg_resources is slow to import, only use it if versioneer's info is not available
+	try:
+		from ._version import get_versions
+		return get_versions()['version']
+	except:
+		pass
+	try:
+		import pkg_resources
+		return pkg_resources.get_distribution("mrbeam_ledstrips").version
+	except:
+		return '-'
+
+
+# defined above, so the client can import get_version_string
 from .client import client
-from .server import server
 
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+__version__ = get_version_string()
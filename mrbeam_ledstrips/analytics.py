@@ -1,6 +1,4 @@
 # coding=utf-8
-from __future__ import absolute_import
-
 import threading
 import time
 import logging
@@ -10,9 +8,10 @@ import os
 import pwd
 import sys
 import types
-import pkg_resources
 import traceback
-from inspect import getframeinfo, stack
+import queue
+
+from . import get_version_string
 
 
 """
@@ -33,11 +32,34 @@ TYPE_LOGEVENT = 'log_event'
 
 RETRIES_WAIT_TIMES = [1.0, 2.0, 5.0, 10.0]
 
+OCTOPRINT_CMD = '/home/pi/oprint/bin/octoprint'
+OCTOPRINT_ANALYTICS_ARGS = ['plugins', 'mrbeam:analytics']
+
 ANALYTICS_THREAD_NAME = 'send_analytics'
 
+# analytics can also be switched off for the whole process with MRB_ANALYTICS=0
+ANALYTICS_ENABLED = os.environ.get('MRB_ANALYTICS', '1') == '1'
+
+# events queued up while the sending thread is busy. Further events get dropped.
+ANALYTICS_QUEUE_SIZE = 1024
+
+# filename as seen by the interpreter, used to skip our own frames when looking for the caller
+_THIS_FILE = sys._getframe().f_code.co_filename
+
+_LEVEL_NAMES = {lvl: logging.getLevelName(lvl) for lvl in (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL)}
+
 _logger = logging.getLogger(__name__)
-_analytics_queue = []
+_callsite_cache = dict()
+# json.dumps() creates a new encoder for every call with non-default options, so we keep one around.
+# Compact separators keep the payload that ends up on octoprint's command line small.
+_json_encoder = json.JSONEncoder(sort_keys=False, separators=(',', ':'))
+_analytics_queue = queue.Queue(maxsize=ANALYTICS_QUEUE_SIZE)
 _analytics_thread = None
+_analytics_thread_lock = threading.Lock()
+_analytics_dropped = 0
+_octoprint_available = None
+_user_envs = dict()
+_user_records = dict()
 
 
 def send_log_event(level, msg, *args, **kwargs):
@@ -48,6 +70,8 @@ def send_log_event(level, msg, *args, **kwargs):
 	:param args:
 	:param kwargs:
 	"""
+	if not ANALYTICS_ENABLED:
+		return
 	msg = msg % args if args and msg else msg
 
 	exception_str = None
@@ -58,35 +82,52 @@ def send_log_event(level, msg, *args, **kwargs):
 		stacktrace = traceback.format_tb(tb)
 
 	data=dict(
-		level = logging.getLevelName(level),
+		level = _LEVEL_NAMES.get(level) or logging.getLevelName(level),
 		msg = msg,
 		exception_str=exception_str,
 		stacktrace=stacktrace,
 	)
 
-	caller = None
-	caller_myself = getframeinfo(stack()[0][0])
-	i = 1
-	while caller is None or caller.filename == caller_myself.filename:
-		caller = getframeinfo(stack()[i][0])
-		i += 1
+	# walk up the frames directly instead of inspect.stack(), which snapshots every frame and reads source files
+	caller = sys._getframe(1)
+	while caller is not None and caller.f_code.co_filename == _THIS_FILE:
+		caller = caller.f_back
 	if caller is not None:
-		filename = caller.filename
-		data.update({
-			'hash': hash('{}{}{}'.format(filename, caller.lineno, _get_version_string())),
-			'file': filename,
-			'line': caller.lineno,
-			'function': caller.function,
-		})
+		data.update(_get_callsite_info(caller.f_code, caller.f_lineno))
 
 	_send_analytics(TYPE_LOGEVENT, data)
 
 
+def _get_callsite_info(code, lineno):
+	"""
+	Returns file, line, function and hash of a log call site. These never change for a given
+	call site, so they are only built once.
+	:param code: code object of the calling frame
+	:param lineno: line number of the call
+	:return: dict
+	"""
+	key = (code, lineno)
+	info = _callsite_cache.get(key)
+	if info is None:
+		filename = code.co_filename
+		info = {
+			'hash': hash('{}{}{}'.format(filename, lineno, get_version_string())),
+			'file': filename,
+			'line': lineno,
+			'function': code.co_name,
+		}
+		_callsite_cache[key] = info
+	return info
+
+
 def hook_into_logger(logger):
 	"""
 	hooks into .exception an .error methods of the given logger.
+	Does nothing if analytics are disabled, so the logger keeps its plain methods.
 	:param logger:
 	"""
+	if not ANALYTICS_ENABLED:
+		return
 	logger.exception = types.MethodType(_exception_overwrite, logger)
 	logger.error = types.MethodType(_error_overwrite, logger)
 
@@ -104,85 +145,115 @@ def _error_overwrite(self, msg, *args, **kwargs):
 
 
 def _send_analytics(type, data):
-	global _logger, _analytics_thread, _analytics_queue
+	global _logger, _analytics_dropped
 	_logger.debug("Sending analytics data: %s %s", type, data)
 	package = dict(
 		component=COMPONENT_NAME,
-		component_version=_get_version_string(),
+		component_version=get_version_string(),
 		type=type,
-		data=json.dumps(data, sort_keys=False)
+		data=_json_encoder.encode(data)
 	)
 
-	# a dedicated sending thread prevents the system from beeing flooded with too many analytics data
-	_analytics_queue.append(package)
+	# a single dedicated sending thread prevents the system from beeing flooded with too many analytics data
+	try:
+		_analytics_queue.put_nowait(package)
+	except queue.Full:
+		_analytics_dropped += 1
+		_logger.debug("Analytics queue full, dropped event. (%s dropped in total)", _analytics_dropped)
+	_start_send_thread()
+
 
-	if not _analytics_thread:
-		_analytics_thread = threading.Thread(target=_send_thread, name=ANALYTICS_THREAD_NAME)
-		_analytics_thread.daemon = True
-		_analytics_thread.start()
+def _start_send_thread():
+	global _analytics_thread
+	with _analytics_thread_lock:
+		if _analytics_thread is None:
+			_analytics_thread = threading.Thread(target=_send_thread, name=ANALYTICS_THREAD_NAME)
+			_analytics_thread.daemon = True
+			_analytics_thread.start()
 
 
 def _send_thread():
-	global _logger, _analytics_thread, _analytics_queue
-	try:
-		while _analytics_queue:
-			package = _analytics_queue.pop(0)
-			retries = len(RETRIES_WAIT_TIMES)
-			cmd = ['/home/pi/oprint/bin/octoprint', 'plugins', 'mrbeam:analytics',
-			       '{}'.format(package['component']),
-			       '{}'.format(package['component_version']),
-			       '{}'.format(package['type']),
-			       '{}'.format(package['data']),
-			       ]
-
-			while retries >= 0:
-				res = _exec_as_user(cmd_list=cmd, user_name='pi')
-				if res:
-					break
-				sleep_time = RETRIES_WAIT_TIMES[retries * -1]
-				time.sleep(sleep_time)
-				retries -= 1
-		_analytics_thread = None
+	while True:
+		package = _analytics_queue.get()
+		try:
+			_send_package(package)
+		except:
+			_logger.log(logging.ERROR, "Exception in _send_thread() ", exc_info=True)
+
+
+def _send_package(package):
+	global _octoprint_available
+	if _octoprint_available is None:
+		_octoprint_available = os.access(OCTOPRINT_CMD, os.X_OK)
+		if not _octoprint_available:
+			_logger.warn("%s not found, analytics data will not be sent.", OCTOPRINT_CMD)
+	if not _octoprint_available:
+		# no point in forking a process (and retrying) that can't be executed
 		return
-	except:
-		_logger.log(logging.ERROR, "Exception in _send_thread() ", exc_info=True)
 
+	cmd = [OCTOPRINT_CMD] + OCTOPRINT_ANALYTICS_ARGS + [
+	       '{}'.format(package['component']),
+	       '{}'.format(package['component_version']),
+	       '{}'.format(package['type']),
+	       '{}'.format(package['data']),
+	       ]
 
-def _get_version_string():
-	try:
-		from mrbeam_ledstrips import __version__
-		return __version__
-	except:
-		pass
-	try:
-		return pkg_resources.get_distribution(COMPONENT_NAME).version
-	except:
-		return None
+	if _exec_as_user(cmd_list=cmd, user_name='pi'):
+		return
+	for sleep_time in RETRIES_WAIT_TIMES:
+		time.sleep(sleep_time)
+		if _exec_as_user(cmd_list=cmd, user_name='pi'):
+			return
 
 
 def _exec_as_user(cmd_list, user_name):
 	global _logger
-	pw_record = pwd.getpwnam(user_name)
-	user_name      = pw_record.pw_name
-	user_home_dir  = pw_record.pw_dir
-	cwd            = pw_record.pw_dir
-	user_uid       = pw_record.pw_uid
-	user_gid       = pw_record.pw_gid
-	env = os.environ.copy()
-	env[ 'HOME'     ]  = user_home_dir
-	env[ 'LOGNAME'  ]  = user_name
-	env[ 'PWD'      ]  = cwd
-	env[ 'USER'     ]  = user_name
-	process = subprocess.Popen(cmd_list, preexec_fn=_demote(user_uid, user_gid), cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	stdout, stderr = process.communicate()
+	user_name, user_home_dir, user_uid, user_gid, demote = _get_user_record(user_name)
+	cwd = user_home_dir
+	env = _get_user_env(user_name, user_home_dir, cwd)
+	# stderr goes along with stdout, so a failure can be logged with what octoprint had to say about it
+	process = subprocess.Popen(cmd_list, preexec_fn=demote, cwd=cwd, env=env,
+	                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	output, _ = process.communicate()
 	returncode = process.returncode
 
 	if returncode != 0:
-		_logger.warn("exec_as_user() ran as user '%s' (uid:%s, gid:%s) returncode: %s, stdout: %s", user_name, user_uid, user_gid, returncode, stdout)
+		_logger.warn("exec_as_user() ran as user '%s' (uid:%s, gid:%s) returncode: %s, output: %s", user_name, user_uid, user_gid, returncode, output)
 
 	return returncode == 0
 
 
+def _get_user_record(user_name):
+	"""
+	Returns (name, home dir, uid, gid, demote function) of the given user.
+	The passwd lookup goes through NSS, so it's only done once per user.
+	"""
+	record = _user_records.get(user_name)
+	if record is None:
+		pw_record = pwd.getpwnam(user_name)
+		record = (pw_record.pw_name, pw_record.pw_dir, pw_record.pw_uid, pw_record.pw_gid,
+		          _demote(pw_record.pw_uid, pw_record.pw_gid))
+		_user_records[user_name] = record
+	return record
+
+
+def _get_user_env(user_name, user_home_dir, cwd):
+	"""
+	Returns the environment for a child process run as the given user.
+	Built once per user from our own environment; Popen doesn't modify it so it can be shared.
+	"""
+	key = (user_name, user_home_dir, cwd)
+	env = _user_envs.get(key)
+	if env is None:
+		env = os.environ.copy()
+		env[ 'HOME'     ]  = user_home_dir
+		env[ 'LOGNAME'  ]  = user_name
+		env[ 'PWD'      ]  = cwd
+		env[ 'USER'     ]  = user_name
+		_user_envs[key] = env
+	return env
+
+
 def _demote(user_uid, user_gid):
 	def result():
 		os.setgid(user_gid)
@@ -3,51 +3,47 @@
 
 import socket
 import sys
-import pkg_resources
+from contextlib import closing
+
+from . import get_version_string
 
-PY3 = sys.version_info >= (3,0)
 CLIENT_TIMEOUT = 5 # in seconds
+RECV_BUF_SIZE = 4 * 1024
 
 def client():
 
 	if len(sys.argv) <= 1:
-		print(("MrBeam LED Strips v{}".format(get_version_string())))
+		print("MrBeam LED Strips v{}".format(get_version_string()))
 		sys.exit(0)
 
 
 	state = sys.argv[1]
 
 	socket_file = "/var/run/mrbeam_ledstrips.sock"
-	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-	s.settimeout(CLIENT_TIMEOUT)
-	try:
-		s.connect(socket_file)
-	except socket.error as msg:
-		print(("socket error: %s " % msg))
-		print(("Unable to connect to: %s. Daemon running?" % socket_file))
-		sys.exit(1)
-
-	try:
-		print(("> " + state))
-		if PY3:
-			s.sendall(bytes(state, "utf8"))
-		else:
-			s.send(state+'\x00')
-		data = s.recv(4*1024)
-		if PY3:
-			print(("< " + str(data, "utf8")))
-		else:
-			print(("< " + data))
-
-	finally:
-		s.close()
-
-
-def get_version_string():
-	try:
-		return pkg_resources.get_distribution("mrbeam_ledstrips").version
-	except:
-		return '-'
+	with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as s:
+		s.settimeout(CLIENT_TIMEOUT)
+		try:
+			s.connect(socket_file)
+		except socket.error as msg:
+			print("socket error: %s " % msg)
+			print("Unable to connect to: %s. Daemon running?" % socket_file)
+			sys.exit(1)
+
+		msg = state.encode('utf-8')
+		s.sendall(msg)
+		# before waiting for the reply, so a timeout still shows what was sent
+		sys.stdout.buffer.write(b"> " + msg + b"\n")
+		sys.stdout.buffer.flush()
+		buf = bytearray(RECV_BUF_SIZE)
+		n = s.recv_into(buf)
+
+		# pass the reply through without decoding it
+		out = bytearray(b"< ")
+		out += buf[:n]
+		out += b"\n"
+		sys.stdout.buffer.write(out)
+		sys.stdout.buffer.flush()
+
 
 if __name__ == "__main__":
 	client()
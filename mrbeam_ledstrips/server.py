@@ -1,32 +1,46 @@
 # coding=utf-8
-from __future__ import absolute_import
-from __future__ import print_function
-import argparse
 import logging
 import sys
 import threading
 import signal
-import code
-import traceback
-import yaml
 import os
-import pkg_resources
-from .state_animations import LEDs, COMMANDS
+import time
+import selectors
+import socket
+
+from . import get_version_string
 
 SOCK_BUF_SIZE = 4 * 1024
-PY3 = sys.version_info >= (3,0)
+SOCK_BACKLOG = 16
+# kernel buffer size for the socket. Commands and replies are tiny, the info reply is a few kB.
+SOCK_KERNEL_BUF_SIZE = 8 * 1024
+# everyone may send commands, e.g. octoprint running as user pi
+SOCK_MODE = 0o666
+# connections that started with KEEPALIVE_COMMAND are kept open for further commands
+# until the client closes them or stays silent for this long
+CONNECTION_IDLE_TIMEOUT = 5
+KEEPALIVE_COMMAND = "keepalive"
+KEEPALIVE_RESPONSE = b"OK keepalive"
+ERROR_RESPONSE = b"ERROR : error while processing message from client\x00"
+# identical consecutive commands within this many seconds are answered without touching the LEDs
+DEDUPE_WINDOW = 1.0
+# longer commands are rejected without bothering the LEDs. The longest real ones are png filenames and spread_spectrum.
+MAX_COMMAND_LENGTH = 128
+
+INFO_TEMPLATE = """INFO: 
+version: {version}
+LEDS: state:{{leds.state}}, frame:{{leds.frame}}, fps:{{leds.fps}}, frame_duration:{{leds.frame_duration}}, job_progress:{{leds.job_progress}}, brightness:{{leds.brightness}}, edge_brightness:{{leds.edge_brightness}}, inside_brightness:{{leds.inside_brightness}}
+LEDS config: {{leds.config}}
+THREADS: ({{num}}) {{threads}}
+COMMANDS: {commands}
+"""
 
 def merge_config(default, config):
-    # See octoprint.util.dict_merge
-    result = dict()
-    for k, v in default.items():
-        result[k] = v
-        if isinstance(v, dict):
-            result[k] = merge_config(v, config[k] if k in config else dict())
-        else:
-            if k in config:
-                result[k] = config[k]
-
+    # The config is flat, so there's no need for a recursive merge like octoprint.util.dict_merge.
+    # Only keys known in default are taken from config.
+    result = dict(default)
+    if config:
+        result.update((k, v) for k, v in config.items() if k in default)
     return result
 
 
@@ -55,16 +69,21 @@ def get_config(path):
         frames_per_second = 28,
 
         # max png file size 30 kB
-        max_png_size = 30 * 1024
+        max_png_size = 30 * 1024,
+
+        # send errors to octoprint's analytics plugin
+        enable_analytics = True,
     )
 
-    import os
     if os.path.exists(path):
+        import yaml
         try:
+            # use libyaml's parser if it's available, it's a lot faster than the pure python one
+            loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
             with open(path, "r") as f:
-                file_config = yaml.safe_load(f)
+                file_config = yaml.load(f, Loader=loader)
         except:
-            logging.get_logger(__name__).warning("error loading config file")
+            logging.getLogger(__name__).warning("error loading config file", exc_info=True)
             return default_config
         else:
             return merge_config(default_config, file_config)
@@ -75,6 +94,7 @@ def get_config(path):
 class Server(object):
 	def __init__(self, server_address, led_config):
 		self.logger = logging.getLogger(__name__)
+		# the analytics module isn't even imported if it's switched off
 		self.analytics = led_config.get('enable_analytics', True)
 		if self.analytics:
 			from . import analytics
@@ -87,18 +107,36 @@ class Server(object):
 		self.listen()
 
 		self.server_address = server_address
+		# connections are handled one after another, so they can all share one receive buffer
+		self._recv_buf = bytearray(SOCK_BUF_SIZE)
+		self._recv_view = memoryview(self._recv_buf)
 
-		# we need to make sure that client messages and link events are never handled concurrently, so we synchronize via
-		# this mutex
-		self.mutex = threading.RLock()
+		from .state_animations import LEDs, COMMANDS
 		self.leds = LEDs(led_config)
-		print("initialized")
-		signal.signal(signal.SIGTERM, self.leds.clean_exit)  # switch off the LEDs on exit
+		self._progress_commands = set(COMMANDS['PROGRESS'] + COMMANDS['SLICING_PROGRESS'])
+		# version and commands don't change, so they go straight into the info template
+		self._info_template = INFO_TEMPLATE.format(
+			version=get_version_string(),
+			commands=' '.join(sorted(COMMANDS[c][0] for c in COMMANDS)),
+		)
+		self._last_state = None
+		self._last_state_ts = 0
+		self._last_response = None
+		self._running = True
+		self.logger.info("initialized")
+		signal.signal(signal.SIGTERM, self.terminate)
+
+	def terminate(self, sig, frame):
+		# Only stops the socket monitor. It switches off the LEDs on its way out.
+		# The signal also wakes up its select() through the wakeup fd.
+		self._running = False
 
 	# https://stackoverflow.com/a/133384/2631798
 	def debug(self, sig, frame):
 		"""Interrupt running process, and provide a python prompt for
 		interactive debugging."""
+		import code
+		import traceback
 		self.logger.info('debug() frame: %s', traceback.extract_stack())
 
 		# this doesn't work for me so far....
@@ -115,72 +153,164 @@ class Server(object):
 		signal.signal(signal.SIGUSR1, self.debug)  # Register handler
 
 	def _socket_monitor(self, server_address, callback):
-
-		import socket
-		import os
 		try:
 			os.unlink(server_address)
 		except OSError:
 			if os.path.exists(server_address):
 				raise
 
-		self.logger.info('Starting up socket monitor on %s...' % server_address)
+		self.logger.info('Starting up socket monitor on %s...', server_address)
 
 		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		# accepted connections inherit the buffer sizes from the listening socket
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_KERNEL_BUF_SIZE)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_KERNEL_BUF_SIZE)
 		sock.bind(server_address)
-		os.chmod(server_address, 438)
+		# before listen(), so no client can connect before the permissions are set
+		os.chmod(server_address, SOCK_MODE)
 
-		sock.listen(1)
+		sock.listen(SOCK_BACKLOG)
+		sock.setblocking(False)
+
+		# one event loop serves the listening socket and all client connections,
+		# so a slow or idle client can't hold up the others
+		sel = selectors.DefaultSelector()
+		sel.register(sock, selectors.EVENT_READ)
+
+		# signals write to this socket pair, so SIGTERM wakes up the loop right away
+		wakeup_r, wakeup_w = socket.socketpair()
+		wakeup_r.setblocking(False)
+		wakeup_w.setblocking(False)
+		sel.register(wakeup_r, selectors.EVENT_READ)
+		signal.set_wakeup_fd(wakeup_w.fileno())
 
 		try:
-			while True:
-				self.logger.info('Waiting for connection on socket...')
-				connection, client_address = sock.accept()
-				self.logger.info('Client connected...')
-
-				# with self.mutex:
-				try:
-
-					if PY3:
-						with connection:
-							data = str(connection.recv(SOCK_BUF_SIZE), "utf8").strip()
-
-							self.logger.info('Command: %s' % data)
-							response = str(callback(data))
-
-							self.logger.info('Send: %s' % response)
-							connection.sendall(bytes(response, "utf8"))
-
-					else:
-						buffer = []
-						while True:
-							chunk = connection.recv(16)
-							if chunk:
-								buffer.append(chunk)
-								if chunk.endswith('\x00') or chunk.endswith("\n"):
-									break
-
-						data = ''.join(buffer).strip()[:-1]
-						self.logger.info('Command: %s' % data)
-						response = callback(data)
-						connection.sendall(str(response) + '\x00')
-
-				except Exception:
-					self.logger.exception('Got an error while processing message from client, aborting')
-
-					try:
-						connection.sendall(str("ERROR : error while processing message from client") + '\x00')
-					except:
-						pass
+			self.logger.info('Waiting for connections on socket...')
+			while self._running:
+				for key, _ in sel.select(timeout=CONNECTION_IDLE_TIMEOUT):
+					if key.fileobj is sock:
+						self._accept_connection(sock, sel)
+					elif key.fileobj is wakeup_r:
+						wakeup_r.recv(SOCK_BUF_SIZE)
+					elif not self._handle_connection(key.fileobj, key.data, callback):
+						sel.unregister(key.fileobj)
+						key.fileobj.close()
+				self._close_idle_connections(sel)
 		except (KeyboardInterrupt, SystemExit):
 			pass
 		except Exception:
 			self.logger.exception("Exception in socket monitor: ")
 		finally:
-			sock.close()
+			signal.set_wakeup_fd(-1)
+			for key in list(sel.get_map().values()):
+				key.fileobj.close()
+			sel.close()
+			wakeup_w.close()
 			os.unlink(server_address)
 			self.leds.clean_exit(signal.SIGTERM, None)
 
+	def _accept_connection(self, sock, sel):
+		connection, client_address = sock.accept()
+		self.logger.info('Client connected...')
+		# the selector tells us when there's data to read. The timeout only limits how long sendall() may block.
+		connection.settimeout(CONNECTION_IDLE_TIMEOUT)
+		# pending: received bytes of a command whose terminator hasn't arrived yet
+		# keepalive: whether the client asked to send further commands on this connection
+		sel.register(connection, selectors.EVENT_READ,
+					 dict(last_active=time.monotonic(), pending=b"", keepalive=False))
+
+	def _close_idle_connections(self, sel):
+		now = time.monotonic()
+		for key in list(sel.get_map().values()):
+			# only client connections carry data
+			if key.data is not None and now - key.data['last_active'] >= CONNECTION_IDLE_TIMEOUT:
+				self.logger.info('Client idle for %ss, closing connection.', CONNECTION_IDLE_TIMEOUT)
+				sel.unregister(key.fileobj)
+				key.fileobj.close()
+
+	def _handle_connection(self, connection, conn_state, callback):
+		"""
+		Answers the commands waiting on the given connection. The connection is closed after the reply, like it
+		always was, unless the client starts with a terminated KEEPALIVE_COMMAND. Then it can send several
+		terminated commands without reconnecting and the connection stays open until it closes it.
+		:return: False if the connection should be closed
+		"""
+		conn_state['last_active'] = time.monotonic()
+		try:
+			n = connection.recv_into(self._recv_buf)
+			if not n:
+				# the client is done sending, an unterminated rest is its last command
+				if conn_state['pending']:
+					self._answer(connection, [(self._decode_command(conn_state['pending']), b"")], callback)
+				return False
+
+			data = conn_state['pending'] + self._recv_view[:n]
+			commands, rest = self._split_commands(data)
+			if not conn_state['keepalive']:
+				if not commands or commands[0][0] != KEEPALIVE_COMMAND:
+					# a single command like the original clients send, with or without terminator.
+					# Close after the reply, such clients read until EOF.
+					if rest:
+						commands.append((self._decode_command(rest), b""))
+					self._answer(connection, commands, callback)
+					return False
+				conn_state['keepalive'] = True
+				connection.sendall(KEEPALIVE_RESPONSE + commands.pop(0)[1])
+			if len(rest) > SOCK_BUF_SIZE:
+				self.logger.warning('Unterminated command too long, closing connection.')
+				connection.sendall(ERROR_RESPONSE)
+				return False
+			conn_state['pending'] = rest
+			self._answer(connection, commands, callback)
+
+		except Exception:
+			self.logger.exception('Got an error while processing message from client, aborting')
+
+			try:
+				connection.sendall(ERROR_RESPONSE)
+			except:
+				pass
+			return False
+		return True
+
+	def _answer(self, connection, commands, callback):
+		"""
+		Runs the (command, terminator) pairs and sends each reply ended by the terminator of its command,
+		so a client can tell the replies apart.
+		"""
+		for data, terminator in commands:
+			self.logger.info('Command: %s', data)
+			response = callback(data)
+
+			self.logger.info('Send: %s', response)
+			connection.sendall(str(response).encode("utf8") + terminator)
+
+	@classmethod
+	def _split_commands(cls, data):
+		"""
+		Splits received bytes into commands. Clients terminate their commands with a null byte or a newline,
+		and a client may send several of them at once.
+		:return: the (command, terminator) pairs and the unterminated rest, which needs more data before it's a command
+		"""
+		commands = []
+		start = 0
+		while True:
+			end = data.find(b"\x00", start)
+			newline = data.find(b"\n", start)
+			if end < 0 or 0 <= newline < end:
+				end = newline
+			if end < 0:
+				return commands, data[start:]
+			# even a blank command gets its (error) reply, so the replies match the commands one by one
+			commands.append((cls._decode_command(data[start:end]), data[end:end + 1]))
+			start = end + 1
+
+	@staticmethod
+	def _decode_command(data):
+		# strip() only removes stray whitespace, the terminator isn't part of data.
+		# Undecodable bytes just make an unknown command instead of failing the whole connection.
+		return str(data, "utf8", "replace").strip()
+
 	def start(self):
 		self.logger.info("### Starting up ledstrip server v%s...", get_version_string())
 		self.animation = threading.Thread(target=self.leds.loop, kwargs=dict())
@@ -191,50 +321,52 @@ class Server(object):
 
 	def on_state_change(self, state):
 		response = "ERRROR"
+		if not state:
+			return "ERROR empty command"
+		if len(state) > MAX_COMMAND_LENGTH:
+			return "ERROR command too long"
+		# commands are compared against the COMMANDS lists over and over again
+		state = sys.intern(state)
 		if (state in ('info', '?')):
 			info = self.get_info()
 			self.logger.info(info)
 			response = info
 		else:
+			state = self._quantize_progress(state)
+			now = time.monotonic()
+			if state == self._last_state and now - self._last_state_ts < DEDUPE_WINDOW \
+					and state == self.leds.state and not self.leds.ignore_next_command:
+				# OctoPrint tends to send the same state several times in a row
+				return self._last_response
 			response = self.leds.change_state(state)
+			self._last_state = state
+			self._last_state_ts = now
+			self._last_response = response
 		return response
 
-	def get_info(self):
-		info = ["INFO: "]
-
-		info.append("version: {}".format(get_version_string()))
-		info.append(
-			"LEDS: state:{state}, frame:{frame}, fps:{fps}, frame_duration:{frame_duration}, job_progress:{job_progress}, brightness:{brightness}, edge_brightness:{edge_brightness}, inside_brightness:{inside_brightness}".format(
-				state=self.leds.state,
-				frame=self.leds.frame,
-				fps=self.leds.fps,
-				frame_duration=self.leds.frame_duration,
-				job_progress=self.leds.job_progress,
-				brightness=self.leds.brightness, 
-				edge_brightness=self.leds.edge_brightness, 
-				inside_brightness=self.leds.inside_brightness, 
-				))
-
-		info.append("LEDS config: {}".format(self.leds.config))
-
-		thr = threading.enumerate()
-		info.append("THREADS: ({num}) {threads}".format(num=len(thr), threads=thr))
+	def _quantize_progress(self, state):
+		"""
+		Progress commands are rendered in whole percent. Rounding the value here keeps
+		e.g. progress:12.3 and progress:12.4 from being two different states.
+		"""
+		name, sep, value = state.partition(':')
+		if sep and name in self._progress_commands:
+			try:
+				return "{}:{}".format(name, int(float(value)))
+			except (ValueError, OverflowError):
+				# e.g. progress:inf, the animation renders it as 0%
+				pass
+		return state
 
-		my_commands = []
-		for c in COMMANDS:
-			my_commands.append(COMMANDS[c][0])
-		my_commands.sort()
-		info.append("COMMANDS: {}".format(' '.join(my_commands)))
-		info.append('')
-
-		return "\n".join(info)
-
-
-def get_version_string():
-	try:
-		return pkg_resources.get_distribution("mrbeam_ledstrips").version
-	except:
-		return '-'
+	def get_info(self):
+		# listing the threads takes threading's global lock, the count alone is enough unless debugging
+		if self.logger.isEnabledFor(logging.DEBUG):
+			thr = threading.enumerate()
+			num = len(thr)
+		else:
+			thr = ''
+			num = threading.active_count()
+		return self._info_template.format(leds=self.leds, num=num, threads=thr)
 
 
 def start_server(config):
@@ -243,6 +375,7 @@ def start_server(config):
 
 
 def server():
+	import argparse
 	parser = argparse.ArgumentParser(parents=[])
 
 	parser.add_argument("-c", "--config", default="/etc/mrbeam_ledstrips.yaml", help="Config file location")
@@ -260,13 +393,10 @@ def server():
 	args = parser.parse_args()
 
 	if args.version:
-		import sys
 		print("Version: %s" % 0.1)
 		sys.exit(0)
 
 	if args.daemon:
-		import os
-		import sys
 		from .daemon import Daemon
 
 		if args.daemon == "stop":
@@ -3,25 +3,18 @@
 # Author: Teja Philipp (teja@mr-beam.org)
 # using https://github.com/jgarff/rpi_ws281x
 
-from __future__ import division, absolute_import
-
 import signal
 
+import functools
 import os
 import time
 import sys
 import threading
 import logging
+from collections import deque
 
-PY3 = sys.version_info >= (3,0)
-if PY3:
-	import rpi_ws281x as ws
-	from rpi_ws281x import Color
-	PixelStrip = ws.PixelStrip
-else:
-	import _rpi_ws281x as ws
-	from neopixel import Color, Adafruit_NeoPixel
-	PixelStrip = Adafruit_NeoPixel
+import rpi_ws281x as ws
+from rpi_ws281x import Color, PixelStrip
 
 
 # LED strip configuration:
@@ -34,30 +27,142 @@ LEDS_LEFT_BACK =   [39, 40, 41, 42, 43, 44, 45]
 # order is right -> left
 LEDS_INSIDE =      [14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31]
 
+# combinations of the above that the animations use on every frame
+CORNER_REGISTERS = (LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK)
+# the LEDs of each row of the four corners, top -> down
+CORNER_ROWS = tuple(zip(*CORNER_REGISTERS))
+INSIDE_LEDS = frozenset(LEDS_INSIDE)
+OUTSIDE_LEDS = tuple(LEDS_RIGHT_FRONT + LEDS_LEFT_FRONT + LEDS_RIGHT_BACK + LEDS_LEFT_BACK)
+# running light around the machine
+IDLE_SEQUENCE = tuple(LEDS_RIGHT_BACK + list(reversed(LEDS_RIGHT_FRONT)) + LEDS_LEFT_FRONT + list(reversed(LEDS_LEFT_BACK)))
+
 # Focus Tool (HW from left to right: 0,1,2,3)
 LEDS_FOCUS_TOOL =  [3,2,1,0]
 
 
 
-# color definitions
-OFF =    Color(0, 0, 0)
-WHITE =  Color(255, 255, 255)
-RED =    Color(255, 0, 0)
-GREEN =  Color(0, 255, 0)
-BLUE =   Color(0, 0, 255)
-YELLOW = Color(255, 200, 0)
-ORANGE = Color(226, 83, 3)
-RED2 =   Color(2, 0, 0)
+# color definitions, packed like Color(r, g, b): 0xRRGGBB
+OFF =    0x000000
+WHITE =  0xFFFFFF
+RED =    0xFF0000
+GREEN =  0x00FF00
+BLUE =   0x0000FF
+YELLOW = 0xFFC800
+ORANGE = 0xE25303
+RED2 =   0x020000
+LIME =   0x96FF00
+GRAY =   0x404040
+DARK_GRAY = 0x141414
 
 FOCUS_TOOL_COLORS = {
-	'O': Color(0,64,0), # OK
-	'W': Color(64,32,0), # WARNING
-	'E': Color(127,0,0), # ERROR
+	'O': 0x004000, # OK
+	'W': 0x402000, # WARNING
+	'E': 0x7F0000, # ERROR
 	'S': None, # don't change / skip
 	'N': OFF, # OFF
-	'P': Color(32,32,32) # Progress
+	'P': 0x202020 # Progress
 }
 
+# on/off steps of the corner animations, one value per LED of a corner (top -> down)
+FLASH_PATTERN = (
+	(0, 0, 0, 0, 0, 0, 0),
+	(0, 0, 0, 1, 0, 0, 0),
+	(0, 0, 1, 1, 1, 0, 0),
+	(0, 1, 1, 1, 1, 1, 0),
+	(1, 1, 1, 1, 1, 1, 1),
+	(1, 1, 1, 1, 1, 1, 1),
+	(0, 1, 1, 1, 1, 1, 0),
+	(0, 0, 1, 1, 1, 0, 0),
+	(0, 0, 0, 1, 0, 0, 0),
+)
+BLINK_PATTERN = (
+	(1, 1, 1, 0, 0, 0, 0),
+	(0, 0, 0, 0, 1, 1, 1),
+)
+
+# custom colors come from clients, so don't let the frame cache grow forever
+PATTERN_CACHE_SIZE = 64
+_pattern_frame_cache = dict()
+
+
+def _pattern_frames(pattern, color):
+	"""
+	Returns the LED colors of a corner for every step of the given pattern.
+	They only depend on pattern and color, so they are built once instead of every frame.
+	"""
+	key = (pattern, color)
+	frames = _pattern_frame_cache.get(key)
+	if frames is None:
+		if len(_pattern_frame_cache) >= PATTERN_CACHE_SIZE:
+			_pattern_frame_cache.clear()
+		frames = tuple(tuple(color if on else OFF for on in step) for step in pattern)
+		_pattern_frame_cache[key] = frames
+	return frames
+
+
+# frame -> animation step for integer state lengths. round() rounds halves to even,
+# so the steps only repeat every 2 * steps * state_length frames.
+PHASE_TABLE_MAX_SIZE = 4096
+_phase_tables = dict()
+
+
+def _phase(frame, state_length, steps):
+	"""Returns int(round(frame / state_length)) % steps, from a lookup table where possible."""
+	table = _phase_tables.get((state_length, steps))
+	if table is None:
+		size = 2 * steps * state_length
+		if not isinstance(state_length, int) or not 0 < size <= PHASE_TABLE_MAX_SIZE:
+			return int(round(frame / state_length)) % steps
+		if len(_phase_tables) >= PATTERN_CACHE_SIZE:
+			_phase_tables.clear()
+		table = _phase_tables[(state_length, steps)] = tuple(int(round(i / state_length)) % steps for i in range(size))
+	return table[frame % len(table)]
+
+
+# triangle wave of the breathing animations per (state_length, fps), see _breath()
+_breath_tables = dict()
+
+
+def _breath(frame, state_length, fps):
+	"""
+	Returns abs((frame/state_length % f_count*2) - (f_count-1))/f_count with f_count = state_length * fps,
+	going from ~1 down to 0 and back up. It repeats every state_length * f_count frames, so it is looked up
+	from a table where possible.
+	"""
+	table = _breath_tables.get((state_length, fps))
+	if table is None:
+		f_count = state_length * fps
+		size = state_length * f_count
+		if size != int(size) or not 0 < size <= PHASE_TABLE_MAX_SIZE:
+			return abs((frame/state_length % f_count*2) - (f_count-1))/f_count
+		if len(_breath_tables) >= PATTERN_CACHE_SIZE:
+			_breath_tables.clear()
+		table = _breath_tables[(state_length, fps)] = tuple(
+			abs((i/state_length % f_count*2) - (f_count-1))/f_count for i in range(int(size)))
+	return table[frame % len(table)]
+
+
+def _get_progress_done_rows(value):
+	l = len(LEDS_RIGHT_BACK)
+	threshold = value / 100.0 * (l-1)
+	return tuple(threshold >= l-i-1 for i in range(l))
+
+# for each progress value, which rows of a corner (top -> down) are lit as done
+PROGRESS_DONE_ROWS = tuple(_get_progress_done_rows(v) for v in range(101))
+
+
+def _progress_done_rows(value):
+	if 0 <= value <= 100:
+		return PROGRESS_DONE_ROWS[value]
+	return _get_progress_done_rows(value)
+
+
+# dimmed colors per brightness setting, see LEDs._dim_by_setting(). Breathing animations produce
+# lots of different colors, so each table is emptied when it reaches this size.
+DIM_TABLE_SIZE = 1024
+_dim_tables = dict()
+
+
 COMMANDS = dict(
 	UNKNOWN                    = ['unknown'],
 	DEBUG_STOP                 = ['DebugStop'],
@@ -156,7 +261,6 @@ class LEDs():
 			from . import analytics
 			analytics.hook_into_logger(self.logger)
 
-		print(("LEDs staring up with config: %s" % self.config))
 		self.logger.info("LEDs staring up with config: %s", self.config)
 
 		# Create NeoPixel object with appropriate configuration.
@@ -168,7 +272,7 @@ class LEDs():
 					spread_spectrum_hopping_delay_ms=self.config['spread_spectrum_hopping_delay_ms'])
 		self.logger.info("LEDs strip initialized")
 		self.state = COMMANDS['LISTENING'][0]
-		self.past_states = []
+		self.past_states = deque(maxlen=10)
 		signal.signal(signal.SIGTERM, self.clean_exit)  # switch off the LEDs on exit
 		self.job_progress = 0
 		self.brightness = self.config['led_brigthness']
@@ -179,8 +283,22 @@ class LEDs():
 		self.update_required = False
 		self._last_interior = None
 		self.ignore_next_command = None
+		# set on state changes to wake up the animation loop early
+		self._wake = threading.Event()
+		# notified by the animation loop once it rendered a new state
+		self._frame_rendered = threading.Condition()
+		self._rendered_state = None
+		self._loop_thread = None
+		self._exit_requested = False
+		# while the animation loop renders a frame, it is only flushed once at the end
+		self._frame_open = False
+		# counts the frames of the animation loop, never reset
+		self._frames_rendered = 0
+		# frame count, lit LED, color and brightness of the last idle() frame
+		self._idle_last = None
 		
 		self.png_animations = dict()
+		self._dispatch = self._build_dispatch()
 
 	def _init_strip(self, freq_hz, spread_spectrum_enabled,
 					spread_spectrum_random=False,
@@ -205,13 +323,29 @@ class LEDs():
 		else:
 			self.logger.info('Spread Spectrum not supported. Install Mr Beams custom rpi_ws281x instead of stock version.')
 		self.strip.begin()  # Init the LED-strip
+		self._pushed_brightness = self.config['led_brigthness']
+		# write pixels straight through the C binding instead of PixelStrip.setPixelColor -> _LED_Data -> binding
+		led_set = getattr(getattr(ws, 'ws', ws), 'ws2811_led_set', None)
+		channel = getattr(self.strip, '_channel', None)
+		if callable(led_set) and channel is not None:
+			self._write_pixel = functools.partial(led_set, channel)
+		else:
+			self._write_pixel = self.strip.setPixelColor
+		# what we've written to the strip, so unchanged LEDs can be skipped without asking the strip
+		self._pixels = [OFF] * self.config['led_count']
+		# what the strip showed at the last show()
+		self._shown = list(self._pixels)
+		# row colors and edge brightness of the last _set_corners(), while nothing else has been written since
+		self._corners_last = None
+		# the last idle() frame, a new strip needs a full frame
+		self._idle_last = None
 
 
 	def change_state(self, nu_state):
 		with self.lock:
 			if self.ignore_next_command:
 				self.ignore_next_command = None
-				print(("state change ignored! keeping: " + str(self.state) + ", ignored: " + str(nu_state)))
+				self.logger.info("state change ignored! keeping: %s, ignored: %s", self.state, nu_state)
 				return "IGNORED {state}   # {old} -> {nu}".format(old=self.state, nu=self.state, state=nu_state)
 
 			# Settings
@@ -226,36 +360,44 @@ class LEDs():
 					return "OK setting {setting} -> {val}".format(setting=setting, val=val)
 
 			old_state = self.state
-			if self.state != nu_state:
-				print(("state change " + str(self.state) + " => " + str(nu_state)))
-				self.logger.info("state change " + str(self.state) + " => " + str(nu_state))
-				if self.state != nu_state:
-					self.past_states.append(self.state)
-					while len(self.past_states) > 10:
-						self.past_states.pop(0)
+			changed = self.state != nu_state
+			if changed:
+				self.logger.info("state change %s => %s", self.state, nu_state)
+				self.past_states.append(self.state)
 				self.state = nu_state
 				self.frame = 0
-				time.sleep(0.2)
-			if self.state == nu_state or \
-					nu_state in COMMANDS['ROLLBACK'] or \
-					nu_state in COMMANDS['IGNORE_NEXT_COMMAND'] or \
-					nu_state in COMMANDS['IGNORE_STOP']:
-				return "OK {state}   # {old} -> {nu}".format(old=old_state, nu=nu_state, state=self.state)
-			else:
-				if self.analytics:
-					from . import analytics
-					analytics.send_log_event(logging.WARNING, "Unknown state: %s", nu_state)
-				return "ERROR {state}   # {old} -> {nu}".format(old=old_state, nu=self.state, state=nu_state)
+
+		# give the animation loop time to pick up the new state. Nothing else needs the lock meanwhile.
+		if changed:
+			self._wake.set()
+			if threading.current_thread() is not self._loop_thread:
+				with self._frame_rendered:
+					self._frame_rendered.wait_for(lambda: self._rendered_state == nu_state, timeout=0.2)
+		if self.state == nu_state or \
+				nu_state in COMMANDS['ROLLBACK'] or \
+				nu_state in COMMANDS['IGNORE_NEXT_COMMAND'] or \
+				nu_state in COMMANDS['IGNORE_STOP']:
+			return "OK {state}   # {old} -> {nu}".format(old=old_state, nu=nu_state, state=self.state)
+		else:
+			if self.analytics:
+				from . import analytics
+				analytics.send_log_event(logging.WARNING, "Unknown state: %s", nu_state)
+			return "ERROR {state}   # {old} -> {nu}".format(old=old_state, nu=self.state, state=nu_state)
 
 	def clean_exit(self, signal, msg):
+		loop_thread = self._loop_thread
+		if loop_thread is not None and loop_thread is not threading.current_thread():
+			# stop the animation loop first, so it doesn't draw over the exit color or use the strip meanwhile
+			self._exit_requested = True
+			self._wake.set()
+			loop_thread.join(1.0)
 		self.static_color(RED2)
 		self.logger.info("shutting down, signal was: %s", signal)
 		#self.off()
 		sys.exit(0)
 
 	def off(self):
-		for i in range(self.strip.numPixels()):
-			self._set_color(i, OFF)
+		self._fill(range(self.strip.numPixels()), OFF, self.edge_brightness)
 		self._update()
 
 	def load_png(self, filename):
@@ -283,7 +425,7 @@ class LEDs():
 		
 		# check if exists, is_readable, file_size
 		if os.path.isfile(path_to_png) and os.path.getsize(path_to_png) < self.config['max_png_size']: 
-			self.logger.info("loading png animation {}".format(filename))
+			self.logger.info("loading png animation %s", filename)
 			img_4channel = cv2.imread(path_to_png, cv2.IMREAD_UNCHANGED)
 			height, width, channels = img_4channel.shape
 			
@@ -336,7 +478,7 @@ class LEDs():
 		
 		if(animation != None):
 			# render frame
-			row = int(round(frame / state_length)) % frames
+			row = _phase(frame, state_length, frames)
 
 			for led in range(self.config['led_count']):
 				color = animation[row][led]
@@ -346,14 +488,22 @@ class LEDs():
 
 
 	def fade_off(self, state_length=0.5, follow_state='ClientOpened'):
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
 		self.logger.info("fade_off()")
+		# each step dims what the strip currently shows, read from our copy of it
+		pixels = self._pixels
+		step_duration = state_length * self.frame_duration
 		for b in self._mylinspace(self.brightness/255.0, 0, 10):
-			for r in involved_registers:
-				for i in range(len(r)):
-					self._set_color(r[i], self.dim_color(self.strip.getPixelColor(r[i]), b))
-			self._update()
-			time.sleep(state_length * self.frame_duration)
+			# the corners show only a few different colors, dim each of them once per step
+			dimmed = dict()
+			for i in OUTSIDE_LEDS:
+				c = pixels[i]
+				d = dimmed.get(c)
+				if d is None:
+					d = dimmed[c] = self.dim_color(c, b)
+				self._set_color(i, d)
+			# each step has to be shown right away, even though it's in the middle of a frame
+			self._flush()
+			time.sleep(step_duration)
 		self.change_state(follow_state)
 
 	@staticmethod
@@ -366,37 +516,15 @@ class LEDs():
 		self.flash(frame, color=RED, state_length=1)
 
 	def flash(self, frame, color=RED, state_length=2):
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
-		l = len(LEDS_RIGHT_BACK)
-
-		frames = [
-			[0, 0, 0, 0, 0, 0, 0],
-			[0, 0, 0, 1, 0, 0, 0],
-			[0, 0, 1, 1, 1, 0, 0],
-			[0, 1, 1, 1, 1, 1, 0],
-			[1, 1, 1, 1, 1, 1, 1],
-			[1, 1, 1, 1, 1, 1, 1],
-			[0, 1, 1, 1, 1, 1, 0],
-			[0, 0, 1, 1, 1, 0, 0],
-			[0, 0, 0, 1, 0, 0, 0]
-		]
-
-		f = int(round(frame / state_length)) % len(frames)
-
-		for r in involved_registers:
-			for i in range(l):
-				if frames[f][i] >= 1:
-					self._set_color(r[i], color)
-				else:
-					self._set_color(r[i], OFF)
+		frames = _pattern_frames(FLASH_PATTERN, color)
+		self._set_corners(frames[_phase(frame, state_length, len(frames))])
 		self._update()
 
 	def breathing(self, frame, color=ORANGE, bg_color=OFF, state_length=2):
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
 		l = len(LEDS_RIGHT_BACK)
 
 		f_count = state_length * self.fps
-		dim = 1 - (abs((frame/state_length % f_count*2) - (f_count-1))/f_count)
+		dim = 1 - _breath(frame, state_length, self.fps)
 
 		my_color = color
 		if isinstance(color, list):
@@ -404,34 +532,24 @@ class LEDs():
 			my_color = color[color_index]
 		dim_color = self.dim_color(my_color, dim)
 
-		for r in involved_registers:
-			for i in range(l):
-				if i >= l-(1 if bg_color==OFF else 2):
-					self._set_color(r[i], dim_color)
-				else:
-					self._set_color(r[i], bg_color)
+		first_lit = l-(1 if bg_color==OFF else 2)
+		self._set_corners([dim_color if i >= first_lit else bg_color for i in range(l)])
 		self._update()
 
 	def breathing_static(self, frame, color=ORANGE, dim=0.2, fade_in=True):
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
 		l = len(LEDS_RIGHT_BACK)
 
 		if fade_in:
 			state_length = 2
 			f_count = state_length * self.fps
 			if frame < f_count:
-				dim_breath = 1 - (abs((frame / state_length % f_count * 2) - (f_count - 1)) / f_count)
+				dim_breath = 1 - _breath(frame, state_length, self.fps)
 				if dim_breath < dim:
 					self.breathing(frame, color=color, state_length=state_length)
 					return
 
 		dim_color = self.dim_color(color, dim)
-		for r in involved_registers:
-			for i in range(l):
-				if i == l-1:
-					self._set_color(r[i], dim_color)
-				else:
-					self._set_color(r[i], OFF)
+		self._set_corners([dim_color if i == l-1 else OFF for i in range(l)])
 		self._update()
 
 	def interior_fade_in(self, frame, force=False):
@@ -442,157 +560,92 @@ class LEDs():
 			if force and self._last_interior == WHITE and frame == 0:
 				interior_color = OFF
 			elif self._last_interior != WHITE:
-				dim_breath = 1 - (abs((frame / state_length % f_count * 2) - (f_count - 1)) / f_count)
+				dim_breath = 1 - _breath(frame, state_length, self.fps)
 				if dim_breath < 1.0:
 					interior_color = self.dim_color(WHITE, dim_breath)
 		self.set_interior(interior_color, perform_update=False)
 
 	def all_on(self):
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
 		l = len(LEDS_RIGHT_BACK)
 
 		color = WHITE
-		for r in involved_registers:
-			l = len(r)
-			for i in range(l):
-				self._set_color(r[i], color)
+		self._set_corners([color] * l)
 		self.brightness = 255
 		self._update()
 
 	# alternating upper and lower yellow
 	def blink(self, frame, color=YELLOW, state_length=8):
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
-		l = len(LEDS_RIGHT_BACK)
-		fwd_bwd_range = list(range(l)) + list(range(l-1, -1, -1))
-
-		frames = [
-			[1, 1, 1, 0, 0, 0, 0],
-			[0, 0, 0, 0, 1, 1, 1]
-		]
-
-		f = int(round(frame / state_length)) % len(frames)
-
-		for r in involved_registers:
-			for i in range(l):
-				if frames[f][i] >= 1:
-					self._set_color(r[i], color)
-				else:
-					self._set_color(r[i], OFF)
+		frames = _pattern_frames(BLINK_PATTERN, color)
+		self._set_corners(frames[_phase(frame, state_length, len(frames))])
 
 		self._update()
 
 	def progress(self, value, frame, color_done=WHITE, color_drip=BLUE, state_length=2):
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
 		l = len(LEDS_RIGHT_BACK)
-		c = int(round(frame / state_length)) % l
-
-		value = self._get_int_val(value)
-
-		for r in involved_registers:
-			for i in range(l):
+		c = _phase(frame, state_length, l)
 
-				bottom_up_idx = l-i-1
-				threshold = value / 100.0 * (l-1)
-				if threshold < bottom_up_idx:
-					if i == c:
-						self._set_color(r[i], color_drip)
-					else:
-						self._set_color(r[i], OFF)
-
-				else:
-					self._set_color(r[i], color_done)
+		done = _progress_done_rows(self._get_int_val(value))
+		self._set_corners([color_done if done[i] else (color_drip if i == c else OFF) for i in range(l)])
 
 		self._update()
 
 	# pauses the progress animation with a pulsing drip
 	def progress_pause(self, value, frame, breathing=True, color_done=WHITE, color_drip=BLUE, state_length=1.5):
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
 		l = len(LEDS_RIGHT_BACK)
-		f_count = state_length * self.fps
-		dim = abs((frame/state_length % f_count*2) - (f_count-1))/f_count if breathing else 1
-
-		value = self._get_int_val(value)
-
-		for r in involved_registers:
-			for i in range(l):
-				bottom_up_idx = l-i-1
-				threshold = value / 100.0 * (l-1)
-				if threshold < bottom_up_idx:
-					if i == bottom_up_idx / 2:
-						color = self.dim_color(color_drip, dim)
-						self._set_color(r[i], color)
-					else:
-						self._set_color(r[i], OFF)
-
-				else:
-					self._set_color(r[i], color_done)
+		dim = _breath(frame, state_length, self.fps) if breathing else 1
 
+		done = _progress_done_rows(self._get_int_val(value))
+		colors = []
+		for i in range(l):
+			if done[i]:
+				colors.append(color_done)
+			elif i == (l-i-1) / 2:
+				colors.append(self.dim_color(color_drip, dim))
+			else:
+				colors.append(OFF)
+		self._set_corners(colors)
 
 		self._update()
 
-	# def drip(self, frame, color=BLUE, state_length=2):
-	# 	involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
-	# 	l = len(LEDS_RIGHT_BACK)
-	# 	c = int(round(frame / state_length)) % l
-	#
-	# 	for r in involved_registers:
-	# 		for i in range(l):
-	# 			if i == c:
-	# 				self._set_color(r[i], color)
-	# 			else:
-	# 				self._set_color(r[i], OFF)
-	#
-	# 	self._update()
-
 	def idle(self, frame, color=WHITE, state_length=1):
-		leds = LEDS_RIGHT_BACK + list(reversed(LEDS_RIGHT_FRONT)) + LEDS_LEFT_FRONT + list(reversed(LEDS_LEFT_BACK))
-		c = int(round(frame / state_length)) % len(leds)
-		for i in range(len(leds)):
-			if i == c:
-				self._set_color(leds[i], color)
-			else:
-				self._set_color(leds[i], OFF)
-
+		leds = IDLE_SEQUENCE
+		c = _phase(frame, state_length, len(leds))
+		last = self._idle_last
+		self._idle_last = (self._frames_rendered, c, color, self.edge_brightness)
+		if last is not None and last[0] == self._frames_rendered - 1 and last[2:] == self._idle_last[2:]:
+			# idle() rendered the previous frame as well, so at most the lit LED moved
+			if last[1] != c:
+				self._set_color(leds[last[1]], OFF)
+				self._set_color(leds[c], color)
+		else:
+			for i in range(len(leds)):
+				if i == c:
+					self._set_color(leds[i], color)
+				else:
+					self._set_color(leds[i], OFF)
 
 		self._update()
 
 	def job_finished(self, frame, state_length=1):
-		# self.illuminate()  # interior light always on
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
-		l = len(LEDS_RIGHT_BACK)
-		f = int(round(frame / state_length)) % (self.fps + l*2)
-
-		if f < l*2:
-			for i in range(int(round(f/2))-1, -1, -1):
-				for r in involved_registers:
-					self._set_color(r[i], GREEN)
-
-		else:
-			for i in range(l-1, -1, -1):
-				for r in involved_registers:
-					brightness = 1 - (f - 2*l)/self.fps * 1.0
-					col = self.dim_color(GREEN, brightness)
-					self._set_color(r[i], col)
-
-		self._update()
+		self._sweep_fill(frame, GREEN, state_length=state_length)
 
 	def dust_extraction(self, frame, state_length=1):
+		self._sweep_fill(frame, WHITE, state_length=state_length)
+
+	# fills the corners top -> down, then fades them out
+	def _sweep_fill(self, frame, color, state_length=1):
 		# self.illuminate()  # interior light always on
-		involved_registers = [LEDS_RIGHT_FRONT, LEDS_LEFT_FRONT, LEDS_RIGHT_BACK, LEDS_LEFT_BACK]
 		l = len(LEDS_RIGHT_BACK)
-		f = int(round(frame / state_length)) % (self.fps + l*2)
+		f = _phase(frame, state_length, self.fps + l*2)
 
 		if f < l*2:
 			for i in range(int(round(f/2))-1, -1, -1):
-				for r in involved_registers:
-					self._set_color(r[i], WHITE)
+				for r in CORNER_REGISTERS:
+					self._set_color(r[i], color)
 
 		else:
-			for i in range(l-1, -1, -1):
-				for r in involved_registers:
-					brightness = 1 - (f - 2*l)/self.fps * 1.0
-					col = self.dim_color(WHITE, brightness)
-					self._set_color(r[i], col)
+			brightness = 1 - (f - 2*l)/self.fps * 1.0
+			self._set_corners([self.dim_color(color, brightness)] * l)
 
 		self._update()
 
@@ -616,32 +669,24 @@ class LEDs():
 		self.static_color(myColor)
 
 	def set_interior(self, color, perform_update=True):
-		color = self.dim_color(color, self.inside_brightness/255.0)
+		color = self._dim_by_setting(color, self.inside_brightness)
 		if self._last_interior != color:
 			self._last_interior = color
-			leds = LEDS_INSIDE
-			l = len(leds)
-			for i in range(l):
-				self._set_color(leds[i], color)
+			self._fill(LEDS_INSIDE, color, self.inside_brightness)
 			if perform_update:
 				self._update()
 
 	def static_color(self, color=WHITE, color_inside=None):
-		outside_leds = LEDS_RIGHT_FRONT + LEDS_LEFT_FRONT + LEDS_RIGHT_BACK + LEDS_LEFT_BACK
-		for i in range(len(outside_leds)):
-			self._set_color(outside_leds[i], color)
+		self._fill(OUTSIDE_LEDS, color, self.edge_brightness)
 		if(color_inside != None):
-			inside_leds = LEDS_INSIDE
-			for i in range(len(inside_leds)):
-				self._set_color(inside_leds[i], color_inside)
+			self._fill(LEDS_INSIDE, color_inside, self.inside_brightness)
 		self._update()
 
 	def focus_tool_idle(self, frame, state_length=2):
 		leds = LEDS_FOCUS_TOOL
-		f_count = state_length * self.fps
-		dim = abs((frame/state_length % f_count*2) - (f_count-1))/f_count
+		dim = _breath(frame, state_length, self.fps)
 
-		color = self.dim_color(Color(64,64,64), dim)
+		color = self.dim_color(GRAY, dim)
 		l = len(leds)
 		for i in range(l):
 			if i == l-1:
@@ -670,7 +715,8 @@ class LEDs():
 		r = (col & 0xFF0000) >> 16
 		g = (col & 0x00FF00) >> 8
 		b = (col & 0x0000FF)
-		return Color(int(r*brightness), int(g*brightness), int(b*brightness))
+		# same as Color(), without the function call
+		return (int(r*brightness) << 16) | (int(g*brightness) << 8) | int(b*brightness)
 
 	def demo_state(self, frame):
 		f = frame % 4300
@@ -692,7 +738,7 @@ class LEDs():
 		if fps < 1: fps = 1
 		self.fps = fps
 		self.frame_duration = self._get_frame_duration(fps)
-		self.logger.info("set_fps() Changed animation speed: fps:%d (%s s/frame)" % (self.fps, self.frame_duration))
+		self.logger.info("set_fps() Changed animation speed: fps:%d (%s s/frame)", self.fps, self.frame_duration)
 		return fps
 
 	def spread_spectrum(self, params):
@@ -709,7 +755,7 @@ class LEDs():
 				hopping_delay = int(params[4])
 				random = params[5].startswith('r') if len(params) > 5 else False
 				status = "freq=%s, bandwidth=%s, channel_width=%s, hopping_delay=%s, random:%s" % (freq, bandwidth, channel_width, hopping_delay, random)
-				self.logger.info("spread_spectrum() on: " + status)
+				self.logger.info("spread_spectrum() on: %s", status)
 				self._init_strip(freq, True,
 					spread_spectrum_random=random,
 					spread_spectrum_bandwidth=bandwidth,
@@ -746,10 +792,260 @@ class LEDs():
 		if frame > max_frames:
 			self.rollback(steps=steps)
 
+	def _build_dispatch(self):
+		"""
+		Maps every command alias to its render function and interior color, so loop() needs a
+		single dict lookup per frame instead of testing the commands one after the other.
+		Render functions get the command's parameters. An interior color of None leaves the interior alone.
+		"""
+		handlers = dict(
+			# Daemon listening
+			LISTENING                  = self._render_listening,
+			UNKNOWN                    = self._render_listening,
+			LISTENING_NET              = lambda params: self.breathing(self.frame, color=WHITE),
+			LISTENING_AP               = lambda params: self.breathing(self.frame, color=LIME),
+			LISTENING_AP_AND_NET       = lambda params: self.breathing(self.frame, color=[LIME, WHITE]),
+			LISTENING_FINDMRBEAM       = lambda params: self.breathing(self.frame, color=ORANGE),
+			LISTENING_COLOR            = self._render_listening_color,
+
+			# test purposes
+			ON                         = lambda params: self.all_on(),
+			ROLLBACK                   = lambda params: self.rollback(2),
+
+			# Server
+			CLIENT_OPENED              = lambda params: self.idle(self.frame),
+			CLIENT_CLOSED              = lambda params: self.breathing(self.frame),
+
+			# Machine
+			ERROR                      = lambda params: self.error(self.frame),
+			SHUTDOWN_PREPARE           = lambda params: self.shutdown_prepare(self.frame),
+			SHUTDOWN                   = lambda params: self.shutdown(self.frame),
+			SHUTDOWN_PREPARE_CANCEL    = lambda params: self.rollback(2),
+
+			# Laser Job
+			PRINT_STARTED              = lambda params: self.progress(0, self.frame),
+			PRINT_DONE                 = self._render_dust_extraction,
+			PRINT_CANCELLED            = self._render_dust_extraction,
+			LASER_JOB_DONE             = self._render_laser_job_done,
+			LASER_JOB_CANCELLED        = self._render_laser_job_cancelled,
+			LASER_JOB_FAILED           = lambda params: self.fade_off(),
+			PRINT_PAUSED               = lambda params: self.progress_pause(self.job_progress, self.frame),
+			PRINT_PAUSED_TIMEOUT       = lambda params: self.progress_pause(self.job_progress, self.frame, False),
+			PRINT_PAUSED_TIMEOUT_BLOCK = self._render_print_paused_timeout_block,
+			PRINT_RESUMED              = lambda params: self.progress(self.job_progress, self.frame),
+			PROGRESS                   = self._render_progress,
+			JOB_FINISHED               = lambda params: self.job_finished(self.frame),
+			PAUSE                      = lambda params: self.progress_pause(self.job_progress, self.frame),
+			READY_TO_PRINT             = lambda params: self.flash(self.frame, color=BLUE, state_length=2),
+			READY_TO_PRINT_CANCEL      = lambda params: self.idle(self.frame),
+			BUTTON_PRESS_REJECT        = self._render_button_press_reject,
+
+			# Slicing
+			SLICING_STARTED            = lambda params: self.progress(0, self.frame, color_done=BLUE, color_drip=WHITE, state_length=3),
+			SLICING_DONE               = lambda params: self.progress(100, self.frame, color_done=BLUE, color_drip=WHITE, state_length=3),
+			SLICING_CANCELLED          = lambda params: self.idle(self.frame),
+			SLICING_FAILED             = lambda params: self.fade_off(),
+			SLICING_PROGRESS           = lambda params: self.progress(params.pop(0), self.frame, color_done=BLUE, color_drip=WHITE, state_length=3),
+
+			# Settings
+			SETTINGS_UPDATED           = self._render_settings_updated,
+
+			# Lens calibration
+			LENS_CALIBRATION           = self._render_lens_calibration,
+
+			# other
+			PNG_ANIMATION              = lambda params: self.png(params.pop(0), self.frame, state_length=1), # mrbeamledstrips_cli png:test.png
+			OFF                        = lambda params: self.off(),
+
+			# colors
+			WHITE                      = self._static_color_renderer(WHITE),
+			RED                        = self._static_color_renderer(RED),
+			GREEN                      = self._static_color_renderer(GREEN),
+			BLUE                       = self._static_color_renderer(BLUE),
+			YELLOW                     = self._static_color_renderer(YELLOW),
+			ORANGE                     = self._static_color_renderer(ORANGE),
+			CUSTOM_COLOR               = self._render_custom_color,
+
+			FLASH_WHITE                = self._flash_renderer(WHITE),
+			FLASH_RED                  = self._flash_renderer(RED),
+			FLASH_GREEN                = self._flash_renderer(GREEN),
+			FLASH_BLUE                 = self._flash_renderer(BLUE),
+			FLASH_YELLOW               = self._flash_renderer(YELLOW),
+			FLASH_ORANGE               = self._flash_renderer(ORANGE),
+			FLASH_CUSTOM_COLOR         = self._render_flash_custom_color,
+
+			BLINK_WHITE                = self._blink_renderer(WHITE),
+			BLINK_RED                  = self._blink_renderer(RED),
+			BLINK_GREEN                = self._blink_renderer(GREEN),
+			BLINK_BLUE                 = self._blink_renderer(BLUE),
+			BLINK_YELLOW               = self._blink_renderer(YELLOW),
+			BLINK_ORANGE               = self._blink_renderer(ORANGE),
+			BLINK_CUSTOM_COLOR         = self._render_blink_custom_color,
+
+			FOCUS_TOOL_IDLE            = lambda params: self.focus_tool_idle(self.frame),
+			FOCUS_TOOL_STATE           = self._render_focus_tool_state,
+
+			# stuff
+			IGNORE_NEXT_COMMAND        = self._render_ignore_next_command,
+			IGNORE_STOP                = self._render_ignore_stop,
+			DEBUG_STOP                 = self._render_debug_stop,
+		)
+		interiors = dict(
+			LISTENING = None, # skip interior
+			UNKNOWN   = None,
+			OFF       = OFF,
+		)
+
+		dispatch = dict()
+		for command, aliases in COMMANDS.items():
+			entry = (handlers[command], interiors.get(command, WHITE))
+			for alias in aliases:
+				dispatch[alias] = entry
+		return dispatch
+
+	def _render_listening(self, params):
+		self.interior_fade_in(self.frame)
+		self.breathing_static(self.frame, color=WHITE, dim=0.05)
+
+	def _render_listening_color(self, params):
+		try:
+			color = Color(int(params.pop(0)), int(params.pop(0)), int(params.pop(0)))
+			bg_color = OFF
+			if len(params) >= 3:
+				bg_color = Color(int(params.pop(0)), int(params.pop(0)), int(params.pop(0)))
+			self.breathing(self.frame, color=color, state_length=2, bg_color=bg_color)
+		except:
+			self.logger.exception("Error in listening_color command: %s", self.state)
+			self.set_state_unknown()
+
+	def _render_dust_extraction(self, params):
+		self.job_progress = 0
+		self.dust_extraction(self.frame)
+
+	def _render_laser_job_done(self, params):
+		self.job_progress = 0
+		self.job_finished(self.frame)
+
+	def _render_laser_job_cancelled(self, params):
+		self.job_progress = 0
+		self.fade_off()
+
+	def _render_print_paused_timeout_block(self, params):
+		if self.frame > self.fps:
+			self.change_state(COMMANDS['PRINT_PAUSED_TIMEOUT'][0])
+		else:
+			self.progress_pause(self.job_progress, self.frame, False, color_drip=RED)
+
+	def _render_progress(self, params):
+		self.job_progress = params.pop(0)
+		self.progress(self.job_progress, self.frame)
+
+	def _render_button_press_reject(self, params):
+		if self.frame > self.fps:
+			self.rollback()
+		else:
+			self.progress_pause(self.job_progress, self.frame, False, color_drip=RED)
+
+	def _render_settings_updated(self, params):
+		if self.frame > 50:
+			self.rollback()
+		else:
+			self.flash(self.frame, color=WHITE, state_length=1)
+
+	def _render_lens_calibration(self, params):
+		self.static_color(color=BLUE, color_inside=WHITE)
+		self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
+
+	def _static_color_renderer(self, color):
+		def render(params):
+			self.static_color(color)
+			self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
+		return render
+
+	def _render_custom_color(self, params):
+		try:
+			r = int(params.pop(0))
+			g = int(params.pop(0))
+			b = int(params.pop(0))
+			self.static_color(Color(r, g, b))
+			self.rollback_after_frames(self.frame, params.pop(0) if len(params)>0 else 0)
+		except:
+			self.logger.exception("Error in color command: %s", self.state)
+			self.set_state_unknown()
+
+	def _flash_renderer(self, color):
+		def render(params):
+			state_length = int(params.pop(0)) if len(params) > 0 else 1
+			self.flash(self.frame, color=color, state_length=state_length)
+			self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
+		return render
+
+	def _render_flash_custom_color(self, params):
+		try:
+			r = int(params.pop(0))
+			g = int(params.pop(0))
+			b = int(params.pop(0))
+			state_length = int(params.pop(0)) if len(params) > 0 else 1
+			self.flash(self.frame, color=Color(r, g, b), state_length=state_length)
+			self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
+		except:
+			self.logger.exception("Error in flash_color command: %s", self.state)
+			self.set_state_unknown()
+
+	def _blink_renderer(self, color):
+		def render(params):
+			state_length = int(params.pop(0)) if len(params) > 0 else 8
+			self.blink(self.frame, color=color, state_length=state_length)
+			self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
+		return render
+
+	def _render_blink_custom_color(self, params):
+		my_color = YELLOW
+		try:
+			r = int(params.pop(0))
+			g = int(params.pop(0))
+			b = int(params.pop(0))
+			my_color = Color(r, g, b)
+		except:
+			pass
+		state_length = int(params.pop(0)) if len(params) > 0 else 8
+		self.blink(self.frame, color=my_color, state_length=state_length)
+		self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
+
+	def _render_focus_tool_state(self, params):
+		states = []
+		try:
+			while(len(params) >= 2):
+				led_idx = int(params.pop(0))
+				led_status = params.pop(0)
+				states.append( (led_idx, led_status) )
+
+			self.focus_tool_state(self.frame, states)
+		except:
+			self.logger.exception("Error in focus_tool_state command: %s", self.state)
+
+	def _render_ignore_next_command(self, params):
+		self.ignore_next_command = COMMANDS['IGNORE_NEXT_COMMAND'][0]
+		self.rollback()
+
+	def _render_ignore_stop(self, params):
+		self.ignore_next_command = None
+		self.rollback()
+
+	def _render_debug_stop(self, params):
+		sleept_time = float(params.pop(0))
+		self.logger.info('DebugStop: going to sleep for %ss. Thread: %s', sleept_time, threading.current_thread())
+		time.sleep(sleept_time)
+		self.logger.info('DebugStop: Woke up!!!. Thread: %s', threading.current_thread())
+		self.rollback()
+
 	def loop(self):
 		try:
+			self._loop_thread = threading.current_thread()
 			self.frame = 0
-			while True:
+			parsed_state = None
+			next_frame = time.monotonic()
+			while not self._exit_requested:
 
 				data = self.state
 				if not data:
@@ -757,297 +1053,57 @@ class LEDs():
 				else:
 					state_string = data
 
-				# split params from state string
-				params = state_string.split(':')
-				my_state = params.pop(0)
-
-				# default interior color
-				interior = WHITE
-				
-				# Daemon listening
-				if my_state in COMMANDS['LISTENING'] or my_state in COMMANDS['UNKNOWN']:
-					interior = None # skip interior
-					self.interior_fade_in(self.frame)
-					self.breathing_static(self.frame, color=WHITE, dim=0.05)
-				elif my_state in COMMANDS['LISTENING_NET']:
-					self.breathing(self.frame, color=WHITE)
-				elif my_state in COMMANDS['LISTENING_AP']:
-					self.breathing(self.frame, color=Color(150, 255, 0))
-				elif my_state in COMMANDS['LISTENING_AP_AND_NET']:
-					self.breathing(self.frame, color=[Color(150, 255, 0), WHITE])
-				elif my_state in COMMANDS['LISTENING_FINDMRBEAM']:
-					self.breathing(self.frame, color=ORANGE)
-				elif my_state in COMMANDS['LISTENING_COLOR']:
-					try:
-						color = Color(int(params.pop(0)), int(params.pop(0)), int(params.pop(0)))
-						bg_color = OFF
-						if len(params) >= 3:
-							bg_color = Color(int(params.pop(0)), int(params.pop(0)), int(params.pop(0)))
-						self.breathing(self.frame, color=color, state_length=2, bg_color=bg_color)
-					except:
-						self.logger.exception("Error in listening_color command: {}".format(self.state))
-						self.set_state_unknown()
-
-				# test purposes
-				elif my_state in COMMANDS['ON']:
-					self.all_on()
-
-				elif my_state in COMMANDS['ROLLBACK']:
-					self.rollback(2)
-
-				# Server
-				elif my_state in COMMANDS['CLIENT_OPENED']:
-					self.idle(self.frame)
-				elif my_state in COMMANDS['CLIENT_CLOSED']:
-					self.breathing(self.frame)
-					# self.idle(self.frame, color=Color(20, 20, 20), fps=10)
-
-				# Machine
-				# elif my_state == "Connected":
-				# 	self.idle(self.frame)
-				# elif my_state == "Disconnected":
-				# 	self.idle(self.frame, fps=10)
-				elif my_state in COMMANDS['ERROR']:
-					self.error(self.frame)
-				elif my_state in COMMANDS['SHUTDOWN_PREPARE']:
-					self.shutdown_prepare(self.frame)
-				elif my_state in COMMANDS['SHUTDOWN']:
-					self.shutdown(self.frame)
-				elif my_state in COMMANDS['SHUTDOWN_PREPARE_CANCEL']:
-					self.rollback(2)
-
-				# Laser Job
-				elif my_state in COMMANDS['PRINT_STARTED']:
-					self.progress(0, self.frame)
-				elif my_state in COMMANDS['PRINT_DONE']:
-					self.job_progress = 0
-					self.dust_extraction(self.frame)
-				elif my_state in COMMANDS['PRINT_CANCELLED']:
-					self.job_progress = 0
-					self.dust_extraction(self.frame)
-
-				elif my_state in COMMANDS['LASER_JOB_DONE']:
-					self.job_progress = 0
-					self.job_finished(self.frame)
-				elif my_state in COMMANDS['LASER_JOB_CANCELLED']:
-					self.job_progress = 0
-					self.fade_off()
-				elif my_state in COMMANDS['LASER_JOB_FAILED']:
-					self.fade_off()
-
-				elif my_state in COMMANDS['PRINT_PAUSED']:
-					self.progress_pause(self.job_progress, self.frame)
-				elif my_state in COMMANDS['PRINT_PAUSED_TIMEOUT']:
-					self.progress_pause(self.job_progress, self.frame, False)
-				elif my_state in COMMANDS['PRINT_PAUSED_TIMEOUT_BLOCK']:
-					if self.frame > self.fps:
-						self.change_state(COMMANDS['PRINT_PAUSED_TIMEOUT'][0])
-					else:
-						self.progress_pause(self.job_progress, self.frame, False, color_drip=RED)
-				elif my_state in COMMANDS['PRINT_RESUMED']:
-					self.progress(self.job_progress, self.frame)
-				elif my_state in COMMANDS['PROGRESS']:
-					self.job_progress = params.pop(0)
-					self.progress(self.job_progress, self.frame)
-				elif my_state in COMMANDS['JOB_FINISHED']:
-					self.job_finished(self.frame)
-				elif my_state in COMMANDS['PAUSE']:
-					self.progress_pause(self.job_progress, self.frame)
-				elif my_state in COMMANDS['READY_TO_PRINT']:
-					self.flash(self.frame, color=BLUE, state_length=2)
-				elif my_state in COMMANDS['READY_TO_PRINT_CANCEL']:
-					self.idle(self.frame)
-				elif my_state in COMMANDS['BUTTON_PRESS_REJECT']:
-					if self.frame > self.fps:
-						self.rollback()
-					else:
-						self.progress_pause(self.job_progress, self.frame, False, color_drip=RED)
-
-				# Slicing
-				elif my_state in COMMANDS['SLICING_STARTED']:
-					self.progress(0, self.frame, color_done=BLUE, color_drip=WHITE, state_length=3)
-				elif my_state in COMMANDS['SLICING_DONE']:
-					self.progress(100, self.frame, color_done=BLUE, color_drip=WHITE, state_length=3)
-				elif my_state in COMMANDS['SLICING_CANCELLED']:
-					self.idle(self.frame)
-				elif my_state in COMMANDS['SLICING_FAILED']:
-					self.fade_off()
-				elif my_state in COMMANDS['SLICING_PROGRESS']:
-					self.progress(params.pop(0), self.frame, color_done=BLUE, color_drip=WHITE, state_length=3)
-
-				# Settings
-				elif my_state in COMMANDS['SETTINGS_UPDATED']:
-					if self.frame > 50:
-						self.rollback()
-					else:
-						self.flash(self.frame, color=WHITE, state_length=1)
-
-				# Lens calibration
-				elif my_state in COMMANDS['LENS_CALIBRATION']:
-					self.static_color(color=BLUE, color_inside=WHITE)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-					
-				# other
-				elif my_state in COMMANDS['PNG_ANIMATION']: # mrbeamledstrips_cli png:test.png
-					filename = params.pop(0)
-					self.png(filename, self.frame, state_length=1)
-				elif my_state in COMMANDS['OFF']:
-					self.off()
-					interior = OFF
-
-				# colors
-				elif my_state in COMMANDS['WHITE']:
-					self.static_color(WHITE)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params)>0 else 0)
-				elif my_state in COMMANDS['RED']:
-					self.static_color(RED)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params)>0 else 0)
-				elif my_state in COMMANDS['GREEN']:
-					self.static_color(GREEN)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params)>0 else 0)
-				elif my_state in COMMANDS['BLUE']:
-					self.static_color(BLUE)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['YELLOW']:
-					self.static_color(YELLOW)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['ORANGE']:
-					self.static_color(ORANGE)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['CUSTOM_COLOR']:
-					try:
-						r = int(params.pop(0))
-						g = int(params.pop(0))
-						b = int(params.pop(0))
-						self.static_color(Color(r, g, b))
-						self.rollback_after_frames(self.frame, params.pop(0) if len(params)>0 else 0)
-					except:
-						self.logger.exception("Error in color command: {}".format(self.state))
-						self.set_state_unknown()
-
-				elif my_state in COMMANDS['FLASH_WHITE']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 1
-					self.flash(self.frame, color=WHITE, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['FLASH_RED']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 1
-					self.flash(self.frame, color=RED, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['FLASH_GREEN']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 1
-					self.flash(self.frame, color=GREEN, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['FLASH_BLUE']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 1
-					self.flash(self.frame, color=BLUE, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['FLASH_YELLOW']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 1
-					self.flash(self.frame, color=YELLOW, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['FLASH_ORANGE']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 1
-					self.flash(self.frame, color=ORANGE, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['FLASH_CUSTOM_COLOR']:
-					try:
-						r = int(params.pop(0))
-						g = int(params.pop(0))
-						b = int(params.pop(0))
-						state_length = int(params.pop(0)) if len(params) > 0 else 1
-						self.flash(self.frame, color=Color(r, g, b), state_length=state_length)
-						self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-					except:
-						self.logger.exception("Error in flash_color command: {}".format(self.state))
-						self.set_state_unknown()
-						
-
-				elif my_state in COMMANDS['BLINK_WHITE']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 8
-					self.blink(self.frame, color=WHITE, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['BLINK_RED']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 8
-					self.blink(self.frame, color=RED, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['BLINK_GREEN']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 8
-					self.blink(self.frame, color=GREEN, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['BLINK_BLUE']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 8
-					self.blink(self.frame, color=BLUE, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['BLINK_YELLOW']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 8
-					self.blink(self.frame, color=YELLOW, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['BLINK_ORANGE']:
-					state_length = int(params.pop(0)) if len(params) > 0 else 8
-					self.blink(self.frame, color=ORANGE, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-				elif my_state in COMMANDS['BLINK_CUSTOM_COLOR']:
-					my_color = YELLOW
-					try:
-						r = int(params.pop(0))
-						g = int(params.pop(0))
-						b = int(params.pop(0))
-						my_color = Color(r, g, b)
-					except:
-						pass
-					state_length = int(params.pop(0)) if len(params) > 0 else 8
-					self.blink(self.frame, color=my_color, state_length=state_length)
-					self.rollback_after_frames(self.frame, params.pop(0) if len(params) > 0 else 0)
-					
-						
-				elif my_state in COMMANDS['FOCUS_TOOL_IDLE']:
-					self.focus_tool_idle(self.frame)
-				elif my_state in COMMANDS['FOCUS_TOOL_STATE']:
-					states = []
-					try:
-						while(len(params) >= 2):
-							led_idx = int(params.pop(0))
-							led_status = params.pop(0)
-							states.append( (led_idx, led_status) )
-
-						self.focus_tool_state(self.frame, states)
-					except:
-						self.logger.exception("Error in focus_tool_state command: {}".format(self.state))
-
-				# stuff
-				elif my_state in COMMANDS['IGNORE_NEXT_COMMAND']:
-					self.ignore_next_command = my_state
-					self.rollback()
-				elif my_state in COMMANDS['IGNORE_STOP']:
-					self.ignore_next_command = None
-					self.rollback()
-				elif my_state in COMMANDS['DEBUG_STOP']:
-					sleept_time = float(params.pop(0))
-					self.logger.info('DebugStop: going to sleep for %ss. Thread: %s', sleept_time, threading.current_thread())
-					time.sleep(sleept_time)
-					self.logger.info('DebugStop: Woke up!!!. Thread: %s', threading.current_thread())
-					self.rollback()
-				else:
-					self.logger.warn("Don't know about command: {}".format(my_state))
+				# the state rarely changes, so it's only split up and looked up when it does
+				if state_string != parsed_state:
+					parsed_state = state_string
+					state_params = state_string.split(':')
+					my_state = state_params.pop(0)
+					entry = self._dispatch.get(my_state)
+				# the render functions consume their params
+				params = list(state_params)
+
+				self._frame_open = True
+				if entry is None:
+					self.logger.warn("Don't know about command: %s", my_state)
 					self.set_state_unknown()
-					self.idle(self.frame, color=Color(20, 20, 20), state_length=2)
+					self.idle(self.frame, color=DARK_GRAY, state_length=2)
+					interior = WHITE
+				else:
+					handler, interior = entry
+					handler(params)
 
 				# set interior at the end
 				if interior is not None:
-					self.set_interior(interior)
+					self.set_interior(interior, perform_update=False)
+				self._frame_open = False
+				self._flush()
+				self._frames_rendered += 1
+
+				if data != self._rendered_state:
+					with self._frame_rendered:
+						self._rendered_state = data
+						self._frame_rendered.notify_all()
 
 				self.frame += 1
 				if self.frame < 0:
 					# int overflow
 					self.frame = 0
-				time.sleep(self.frame_duration)
+
+				# wait until the next frame is due, so rendering time doesn't slow down the animations.
+				# State changes wake us up early to show them right away.
+				next_frame += self.frame_duration
+				delay = next_frame - time.monotonic()
+				if delay > 0 and not self._wake.wait(delay):
+					continue
+				# woken up or running late (e.g. after fade_off), don't rush through frames to catch up
+				self._wake.clear()
+				next_frame = time.monotonic()
 
 		except KeyboardInterrupt:
 			self.logger.exception("KeyboardInterrupt Exception in animation loop:")
 			self.clean_exit(signal.SIGINT, None)
 		except:
 			self.logger.exception("Some Exception in animation loop:")
-			print("Some Exception in animation loop:")
 
 	def set_state_unknown(self):
 		self.state = COMMANDS['UNKNOWN'][0]
@@ -1107,26 +1163,82 @@ class LEDs():
 			val = 0
 		return val
 
+	def _set_corners(self, colors):
+		'''
+		Sets the LEDs of all four corners. All corners show the same, so colors holds
+		one value per row (top -> down) and each of them is only decided once.
+		'''
+		edge_brightness = self.edge_brightness
+		key = (tuple(colors), edge_brightness)
+		if key == self._corners_last:
+			# most animations only change every few frames
+			return
+		for leds, color in zip(CORNER_ROWS, colors):
+			self._fill(leds, color, edge_brightness)
+		self._corners_last = key
+
+	def _fill(self, leds, color, brightness):
+		'''
+		Same as _set_color() for each of the given LEDs, for LEDs that share one brightness setting.
+		The color is only dimmed once and the LEDs are written straight away.
+		'''
+		color = self._dim_by_setting(color, brightness)
+		pixels = self._pixels
+		for i in leds:
+			if pixels[i] != color:
+				pixels[i] = color
+				self._write_pixel(i, color)
+				self.update_required = True
+				self._corners_last = None
+
 	def _set_color(self, i, color):
-		c = self.strip.getPixelColor(i)
-		if(i in LEDS_INSIDE):
-			color = self.dim_color(color, self.inside_brightness/255.0)
+		c = self._pixels[i]
+		if(i in INSIDE_LEDS):
+			color = self._dim_by_setting(color, self.inside_brightness)
 			#self.logger.info('change_inside_brightness: %i, %i', i, color)
 		else:
-			color = self.dim_color(color, self.edge_brightness/255.0)
+			color = self._dim_by_setting(color, self.edge_brightness)
 		if(c != color):
-			self.strip.setPixelColor(i, color)
+			self._pixels[i] = color
+			self._write_pixel(i, color)
 			self.update_required = True
+			self._corners_last = None
 			# self.logger.info("colors did not match update %i : %i" % (color,c))
 		else:
 			# self.logger.debug("skipped color update of led %i" % i)
 			pass
 
+	def _dim_by_setting(self, color, brightness):
+		'''
+		Dims a color by one of the 0..255 brightness settings.
+		Every LED goes through this on every frame, so the results are looked up in a table per brightness value.
+		'''
+		table = _dim_tables.get(brightness)
+		if table is None:
+			table = _dim_tables[brightness] = dict()
+		dimmed = table.get(color)
+		if dimmed is None:
+			if len(table) >= DIM_TABLE_SIZE:
+				table.clear()
+			dimmed = table[color] = self.dim_color(color, brightness/255.0)
+		return dimmed
+
 	def _update(self):
+		if self._frame_open and threading.current_thread() is self._loop_thread:
+			return
+		self._flush()
+
+	def _flush(self):
 		if(self.update_required):
-			self.strip.setBrightness(self.brightness)
-			self.strip.show()
 			self.update_required = False
+			if self.brightness != self._pushed_brightness:
+				self.strip.setBrightness(self.brightness)
+				self._pushed_brightness = self.brightness
+			elif self._pixels == self._shown:
+				# LEDs were changed and changed back within one frame
+				return
+			self.strip.show()
+			self._shown[:] = self._pixels
 			# self.logger.info("state: %s |    flush  !!!", self.state)
 		else:
 			# self.logger.info("state: %s | no flush   - ", self.state)
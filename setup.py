@@ -161,9 +161,7 @@ def get_cmdclass():
     return cmdclass
 
 
-install_requires = ["PyYaml", ]
-if sys.version_info >= (3, 0):
-    install_requires += ["rpi-ws281x; platform_machine=='armv7l'", ]
+install_requires = ["PyYaml", "rpi-ws281x; platform_machine=='armv7l'", ]
 setup(
     name="mrbeam_ledstrips",
     version=versioneer.get_version(),
@@ -176,11 +174,12 @@ setup(
     license="GPLV3",
     packages=["mrbeam_ledstrips"],
     zip_safe=False,
+    python_requires=">=3",
     dependency_links=[],
     install_requires=install_requires,
     entry_points={
         "console_scripts": {
-            "mrbeam_ledstrips = mrbeam_ledstrips:server",
+            "mrbeam_ledstrips = mrbeam_ledstrips.server:server",
             "mrbeam_ledstrips_cli = mrbeam_ledstrips:client"
         }
     },
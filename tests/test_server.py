@@ -0,0 +1,137 @@
+# coding=utf-8
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from mrbeam_ledstrips.server import Server, SOCK_BUF_SIZE
+
+
+def bare_server():
+	# a Server without LEDs and socket monitor, enough for the connection handling
+	server = Server.__new__(Server)
+	server.logger = logging.getLogger(__name__)
+	server._recv_buf = bytearray(SOCK_BUF_SIZE)
+	server._recv_view = memoryview(server._recv_buf)
+	return server
+
+
+def conn_state():
+	return dict(last_active=0, pending=b"", keepalive=False)
+
+
+class HandleConnectionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = bare_server()
+		self.client, self.connection = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.client.settimeout(1)
+		self.commands = []
+
+	def tearDown(self):
+		self.client.close()
+		self.connection.close()
+
+	def callback(self, command):
+		self.commands.append(command)
+		return "OK {}".format(command)
+
+	def test_terminated_commands_get_separable_replies(self):
+		self.client.sendall(b"keepalive\x00a\x00b\x00")
+		self.assertTrue(self.server._handle_connection(self.connection, conn_state(), self.callback))
+		self.assertEqual(self.commands, ["a", "b"])
+		replies = b""
+		while replies.count(b"\x00") < 3:
+			replies += self.client.recv(SOCK_BUF_SIZE)
+		self.assertEqual(replies.split(b"\x00"), [b"OK keepalive", b"OK a", b"OK b", b""])
+
+	def test_terminated_command_without_keepalive_is_answered_and_closed(self):
+		self.client.sendall(b"a\n")
+		self.assertFalse(self.server._handle_connection(self.connection, conn_state(), self.callback))
+		self.assertEqual(self.client.recv(SOCK_BUF_SIZE), b"OK a\n")
+
+	def test_unterminated_command_is_answered_and_closed(self):
+		self.client.sendall(b"a")
+		self.assertFalse(self.server._handle_connection(self.connection, conn_state(), self.callback))
+		self.assertEqual(self.client.recv(SOCK_BUF_SIZE), b"OK a")
+
+
+class FakeLEDs(object):
+
+	def clean_exit(self, signal, frame):
+		pass
+
+
+class SocketMonitorTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = bare_server()
+		self.server.leds = FakeLEDs()
+		self.server._running = True
+		self.tmp_dir = tempfile.mkdtemp()
+		self.address = os.path.join(self.tmp_dir, "ledstrips.sock")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def callback(self, command):
+		if command == "stop":
+			self.server._running = False
+		return "OK {}".format(command)
+
+	def request(self, data):
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+			s.settimeout(10)
+			s.connect(self.address)
+			s.sendall(data)
+			reply = b""
+			while True:
+				chunk = s.recv(SOCK_BUF_SIZE)
+				if not chunk:
+					return reply
+				reply += chunk
+
+	def test_newline_terminated_command_is_closed_after_reply(self):
+		result = {}
+
+		def client():
+			try:
+				while not os.path.exists(self.address):
+					time.sleep(0.01)
+				start = time.monotonic()
+				result['reply'] = self.request(b"info\n")
+				result['duration'] = time.monotonic() - start
+			finally:
+				self.request(b"stop")
+
+		thread = threading.Thread(target=client)
+		thread.start()
+		# the monitor installs the signal wakeup fd, which only works in the main thread
+		self.server._socket_monitor(self.address, self.callback)
+		thread.join()
+		self.assertEqual(result['reply'], b"OK info\n")
+		self.assertLess(result['duration'], 1)
+
+
+class SplitCommandsTest(unittest.TestCase):
+
+	def test_split(self):
+		self.assertEqual(Server._split_commands(b"a\x00b\nc"), ([("a", b"\x00"), ("b", b"\n")], b"c"))
+
+
+class QuantizeProgressTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = bare_server()
+		self.server._progress_commands = {"progress"}
+
+	def test_rounds_to_whole_percent(self):
+		self.assertEqual(self.server._quantize_progress("progress:12.7"), "progress:12")
+
+	def test_infinite_value_is_passed_on(self):
+		self.assertEqual(self.server._quantize_progress("progress:inf"), "progress:inf")
+		self.assertEqual(self.server._quantize_progress("progress:-inf"), "progress:-inf")